@@ -1,18 +1,54 @@
 from fastapi import FastAPI, UploadFile, File
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from groq import Groq
+from contextlib import asynccontextmanager
 import os
+import json
+import re
+import hashlib
+import tempfile
+import threading
 from dotenv import load_dotenv
 from pypdf import PdfReader
-from pdf2image import convert_from_path
-import pytesseract
+try:
+    import fitz  # PyMuPDF, much faster than pypdf when available
+except ImportError:
+    fitz = None
+try:
+    import faiss
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    faiss = None
 import urllib.parse
+import collections
+import asyncio
+import aiofiles
+import tiktoken
+from concurrent.futures import ThreadPoolExecutor
+from ocr import ocr_pdf
 
 load_dotenv()
 
-app = FastAPI()
+# ---------------- GROQ CLIENT ----------------
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+client = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Warn before creating the client, since Groq() raises when the key is missing
+    global client
+    if not GROQ_API_KEY:
+        print("⚠️ GROQ_API_KEY not found in .env")
+    client = Groq(api_key=GROQ_API_KEY)
+    yield
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # ---------------- CORS ----------------
 app.add_middleware(
@@ -23,158 +59,86 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ---------------- GROQ CLIENT ----------------
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-if not GROQ_API_KEY:
-    print("⚠️ GROQ_API_KEY not found in .env")
-
-client = Groq(api_key=GROQ_API_KEY)
-
 # ---------------- STORAGE ----------------
-DOCUMENTS = {}
-CHAT_HISTORY = []
+DOCUMENTS = {}  # filename -> {"hash": md5 of contents, "text": extracted text}
+_DOCS_LOCK = threading.Lock()  # guards DOCUMENTS and the prompt/index rebuilt from it
+_HISTORY_TAIL = collections.deque()  # (message, token count) for recent user/assistant turns
+_HISTORY_TOKENS = 0  # running sum of the token counts in _HISTORY_TAIL
+_HISTORY_LOCK = threading.Lock()  # /ask requests update the history from different threads
+_SYSTEM_MSG = None  # system message built from the first 12000 chars of DOCUMENTS
+
+HISTORY_TOKEN_BUDGET = 6000
+_ENC = tiktoken.get_encoding("cl100k_base")
 
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+UPLOAD_CHUNK_SIZE = 64 * 1024  # 64KB
+MIN_DIGITAL_PAGE_CHARS = 100  # text per page above which OCR is skipped
 ALLOWED_EXTENSIONS = (".pdf", ".txt", ".java", ".py", ".js", ".cpp", ".c", ".html", ".css")
 
-if not os.path.exists("uploads"):
-    os.makedirs("uploads")
-
-pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
-
-
-class Question(BaseModel):
-    question: str
-
-
-# ---------------- FILE LIST ----------------
-@app.get("/files")
-def list_files():
-    return {"files": list(DOCUMENTS.keys())}
-
-
-# ---------------- CLEAR HISTORY ----------------
-@app.post("/clear")
-def clear_history():
-    global CHAT_HISTORY
-    CHAT_HISTORY = []
-    return {"message": "Chat history cleared"}
-
-
-# ---------------- CLEAR ALL ----------------
-@app.post("/clear-all")
-def clear_all():
-    global CHAT_HISTORY, DOCUMENTS
-    CHAT_HISTORY = []
-    DOCUMENTS = {}
-    return {"message": "Session fully reset"}
+CACHE_DIR = "uploads/.cache"
+CACHE_MAX_BYTES = 500 * 1024 * 1024  # 500MB, least recently used entries are evicted past this
+EXTRACTOR_VERSION = 2  # bump when extraction, OCR or chunking output changes so stale cache entries are ignored
 
+os.makedirs(CACHE_DIR, exist_ok=True)
 
-# ---------------- DELETE FILE ----------------
-@app.delete("/delete/{filename}")
-def delete_file(filename: str):
-    global DOCUMENTS
-    key = filename.lower()
-    if key in DOCUMENTS:
-        del DOCUMENTS[key]
-        filepath = f"uploads/{filename}"
-        if os.path.exists(filepath):
-            os.remove(filepath)
-        return {"message": f"{filename} deleted successfully"}
-    return {"message": f"{filename} not found"}
+_THREAD_POOL = ThreadPoolExecutor()
 
+# ---------------- RETRIEVAL ----------------
+CHUNK_SIZE = 2000
+CHUNK_STRIDE = 1800
+TOP_K = 5
 
-# ---------------- UPLOAD ----------------
-@app.post("/upload")
-async def upload_pdf(files: list[UploadFile] = File(...)):
-    global DOCUMENTS, CHAT_HISTORY
-    processed = 0
-    errors = []
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 
-    try:
-        for file in files:
-            if not any(file.filename.lower().endswith(ext) for ext in ALLOWED_EXTENSIONS):
-                errors.append(f"{file.filename} is not supported.")
-                continue
-
-            contents = await file.read()
-            if len(contents) > MAX_FILE_SIZE:
-                errors.append(f"{file.filename} exceeds 10MB limit.")
-                continue
-
-            if file.filename.lower() in DOCUMENTS:
-                print(f"⚠️ Overwriting existing file: {file.filename}")
-
-            filepath = f"uploads/{file.filename}"
-            with open(filepath, "wb") as f:
-                f.write(contents)
-
-            text = ""
-
-            if not file.filename.lower().endswith(".pdf"):
-                try:
-                    text = contents.decode("utf-8")
-                except:
-                    text = contents.decode("latin-1")
-            else:
-                try:
-                    reader = PdfReader(filepath)
-                    for page in reader.pages:
-                        extracted = page.extract_text()
-                        if extracted:
-                            text += extracted + "\n"
-                except:
-                    pass
-
-                try:
-                    images = convert_from_path(filepath)
-                    ocr_text = ""
-                    for img in images:
-                        ocr_text += pytesseract.image_to_string(img)
-                    if ocr_text.strip():
-                        text += "\n" + ocr_text
-                except Exception as e:
-                    print(f"OCR warning for {file.filename}: {e}")
-
-            if not text.strip():
-                errors.append(f"Could not extract text from {file.filename}.")
-                continue
-
-            DOCUMENTS[file.filename.lower()] = text
-            processed += 1
+_EMBED_MODEL = None
+_EMBED_LOCK = threading.Lock()
+# (FAISS index, chunk texts parallel to its vectors); replaced as a whole, never mutated
+_RETRIEVAL = (None, [])
 
-        if processed > 0:
-            CHAT_HISTORY = []
 
-        msg = f"{processed} file(s) processed successfully."
-        if errors:
-            msg += " Issues: " + " | ".join(errors)
+def _get_embed_model():
+    # Loaded on first use so importing main stays cheap
+    global _EMBED_MODEL
+    with _EMBED_LOCK:
+        if _EMBED_MODEL is None:
+            _EMBED_MODEL = SentenceTransformer(EMBED_MODEL_NAME)
+        return _EMBED_MODEL
 
-        return {"message": msg}
 
-    except Exception as e:
-        return {"message": f"Upload failed: {str(e)}"}
+def _embeddings_path(h):
+    # Vectors depend on the embedding model as well as the extracted text
+    model_tag = hashlib.md5(EMBED_MODEL_NAME.encode("utf-8")).hexdigest()[:8]
+    return f"{CACHE_DIR}/{h}-v{EXTRACTOR_VERSION}-{model_tag}.npy"
 
 
-# ---------------- ASK ----------------
-@app.post("/ask")
-def ask_ai(q: Question):
-    global DOCUMENTS, CHAT_HISTORY
+def _embed_document(text, h, cacheable):
+    # Like extracted text, embeddings are only cached for PDFs
+    chunks = [text[i:i + CHUNK_SIZE] for i in range(0, len(text), CHUNK_STRIDE)]
+    path = _embeddings_path(h)
+    if cacheable:
+        try:
+            embeddings = np.load(path)
+            _touch_cache(path)
+            return chunks, embeddings
+        except FileNotFoundError:
+            pass
+    embeddings = _get_embed_model().encode(chunks, normalize_embeddings=True)
+    if cacheable:
+        _write_cache(path, embeddings)
+    return chunks, embeddings
 
-    try:
-        user_text = q.question.lower()
 
-        if DOCUMENTS:
-            combined_text = "\n\n".join(DOCUMENTS.values())[:12000]
-        else:
-            combined_text = ""
+def _retrieve(question):
+    index, chunks = _RETRIEVAL
+    if not chunks:
+        return None
+    q_emb = _get_embed_model().encode([question], normalize_embeddings=True)
+    _, ids = index.search(q_emb, min(TOP_K, len(chunks)))
+    return "\n\n".join(chunks[i] for i in ids[0] if i >= 0)
 
-        image_keywords = ["draw", "generate image", "create diagram", "create flowchart", "show diagram", "make flowchart"]
-        if any(phrase in user_text for phrase in image_keywords):
-            prompt = urllib.parse.quote(q.question)
-            return {"image": f"https://image.pollinations.ai/prompt/{prompt}"}
 
-        system_prompt = f"""
+# ---------------- SYSTEM PROMPT ----------------
+SYSTEM_PROMPT_TEMPLATE = """
 You are an expert AI Study Companion — a supportive, professional tutor.
 
 ## Response Style Rules
@@ -248,25 +212,401 @@ Based on your results, review these concepts:
 {combined_text}
         """
 
-        if not CHAT_HISTORY:
-            CHAT_HISTORY.append({"role": "system", "content": system_prompt})
+
+def _rebuild_combined():
+    # Called whenever DOCUMENTS changes so /ask never rebuilds the prompt itself.
+    # Identical uploads under different names are only included once.
+    global _RETRIEVAL, _SYSTEM_MSG
+    seen = set()
+    parts = []
+    chunks = []
+    vectors = []
+    for doc in DOCUMENTS.values():
+        if doc["hash"] in seen:
+            continue
+        seen.add(doc["hash"])
+        parts.append(doc["text"])
+        if "embeddings" in doc:
+            chunks.extend(doc["chunks"])
+            vectors.append(doc["embeddings"])
+
+    # Build a fresh index and swap it in, so /ask threads mid-search keep a consistent pair
+    index = None
+    if vectors:
+        index = faiss.IndexFlatIP(vectors[0].shape[1])
+        index.add(np.vstack(vectors))
+    _RETRIEVAL = (index, chunks)
+
+    text = "\n\n".join(parts)[:12000]
+    system_prompt = SYSTEM_PROMPT_TEMPLATE.format(combined_text=text)
+    _SYSTEM_MSG = {"role": "system", "content": system_prompt}
+
+
+_rebuild_combined()
+
+
+# ---------------- HISTORY ----------------
+def _remember(role, content):
+    # Token counts are computed once per message and kept in a running total
+    global _HISTORY_TOKENS
+    tokens = len(_ENC.encode_ordinary(content)) + 4
+    message = {"role": role, "content": content}
+    with _HISTORY_LOCK:
+        _HISTORY_TAIL.append((message, tokens))
+        _HISTORY_TOKENS += tokens
+        while len(_HISTORY_TAIL) > 1 and _HISTORY_TOKENS > HISTORY_TOKEN_BUDGET:
+            _HISTORY_TOKENS -= _HISTORY_TAIL.popleft()[1]
+    return message
+
+
+def _forget(message):
+    # Drops a turn that never got an answer, so history has no back-to-back user turns
+    global _HISTORY_TOKENS
+    with _HISTORY_LOCK:
+        for i, (m, tokens) in enumerate(_HISTORY_TAIL):
+            if m is message:
+                del _HISTORY_TAIL[i]
+                _HISTORY_TOKENS -= tokens
+                return
+
+
+def _forget_history():
+    global _HISTORY_TOKENS
+    with _HISTORY_LOCK:
+        _HISTORY_TAIL.clear()
+        _HISTORY_TOKENS = 0
+
+
+def _history_snapshot():
+    # Copied under the lock so building a request never iterates a deque being mutated
+    with _HISTORY_LOCK:
+        return [m for m, _ in _HISTORY_TAIL]
+
+
+class Question(BaseModel):
+    question: str
+
+
+# ---------------- FILE LIST ----------------
+@app.get("/files")
+def list_files():
+    with _DOCS_LOCK:
+        return {"files": list(DOCUMENTS.keys())}
+
+
+# ---------------- CLEAR HISTORY ----------------
+@app.post("/clear")
+def clear_history():
+    _forget_history()
+    return {"message": "Chat history cleared"}
+
+
+# ---------------- CLEAR ALL ----------------
+@app.post("/clear-all")
+def clear_all():
+    global DOCUMENTS
+    _forget_history()
+    with _DOCS_LOCK:
+        DOCUMENTS = {}
+        _rebuild_combined()
+    return {"message": "Session fully reset"}
+
+
+# ---------------- DELETE FILE ----------------
+@app.delete("/delete/{filename}")
+def delete_file(filename: str):
+    global DOCUMENTS
+    key = filename.lower()
+    with _DOCS_LOCK:
+        doc = DOCUMENTS.pop(key, None)
+        if doc is not None:
+            _rebuild_combined()
+    if doc is not None:
+        filepath = f"uploads/{filename}"
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
+        return {"message": f"{filename} deleted successfully"}
+    return {"message": f"{filename} not found"}
+
+
+# ---------------- EXTRACTION CACHE ----------------
+def _cache_path(h):
+    return f"{CACHE_DIR}/{h}-v{EXTRACTOR_VERSION}.txt"
+
+
+def _write_cache(path, data):
+    # Write to a temp file and rename so readers never see a partial entry
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if isinstance(data, str):
+                f.write(data.encode("utf-8"))
+            else:
+                np.save(f, data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    _evict_cache()
+
+
+def _touch_cache(path):
+    # Marks an entry as recently used for eviction
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _evict_cache():
+    # Entries outlive /delete and /clear-all so re-uploads skip OCR; size alone bounds the cache
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith(".tmp"):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+# ---------------- EXTRACTION ----------------
+def _process_file(filename, h):
+    # Blocking extraction work; runs on _THREAD_POOL so the event loop stays free
+    filepath = f"uploads/{filename}"
+
+    if not filename.lower().endswith(".pdf"):
+        with open(filepath, "rb") as f:
+            contents = f.read()
+        try:
+            return h, contents.decode("utf-8")
+        except:
+            return h, contents.decode("latin-1")
+
+    cache_path = _cache_path(h)
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            text = f.read()
+        _touch_cache(cache_path)
+        return h, text
+    except FileNotFoundError:
+        pass
+
+    parts = []
+    needs_ocr = True
+    try:
+        if fitz is not None:
+            with fitz.open(filepath) as doc:
+                first = doc[0] if doc.page_count else None
+                if first is not None and not first.get_text("text").strip() and first.get_images():
+                    # Image-only scan: skip the text pass and go straight to OCR
+                    pages = []
+                else:
+                    pages = [page.get_text() for page in doc]
+                    # Substantial text on the first pages means a digital PDF
+                    needs_ocr = not pages or not all(
+                        len(page.strip()) >= MIN_DIGITAL_PAGE_CHARS for page in pages[:3]
+                    )
         else:
-            CHAT_HISTORY[0] = {"role": "system", "content": system_prompt}
+            pages = [page.extract_text() for page in PdfReader(filepath).pages]
+        for extracted in pages:
+            if extracted:
+                parts.append(extracted)
+                parts.append("\n")
+    except:
+        pass
+
+    if needs_ocr:
+        try:
+            ocr_text = ocr_pdf(filepath)
+            if ocr_text.strip():
+                parts.append("\n")
+                parts.append(ocr_text)
+        except Exception as e:
+            print(f"OCR warning for {filename}: {e}")
+
+    text = "".join(parts)
+
+    if text.strip():
+        _write_cache(cache_path, text)
+
+    return h, text
+
+
+# ---------------- UPLOAD ----------------
+def _store_document(key, doc):
+    with _DOCS_LOCK:
+        DOCUMENTS[key] = doc
+
+
+def _rebuild_locked():
+    with _DOCS_LOCK:
+        _rebuild_combined()
+
+
+async def _handle_upload(file):
+    # Returns an error message, or None once the file is stored in DOCUMENTS
+    if not any(file.filename.lower().endswith(ext) for ext in ALLOWED_EXTENSIONS):
+        return f"{file.filename} is not supported."
+
+    # Copy in chunks instead of holding the whole file in memory. Starlette has already
+    # spooled the request body to disk by now, so the proxy's body limit is the real guard.
+    filepath = f"uploads/{file.filename}"
+    tmp_path = filepath + ".part"
+    md5 = hashlib.md5()
+    total = 0
+    try:
+        async with aiofiles.open(tmp_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                total += len(chunk)
+                if total > MAX_FILE_SIZE:
+                    break
+                md5.update(chunk)
+                await f.write(chunk)
+
+        if total > MAX_FILE_SIZE:
+            return f"{file.filename} exceeds 10MB limit."
+
+        if file.filename.lower() in DOCUMENTS:
+            print(f"⚠️ Overwriting existing file: {file.filename}")
+
+        os.replace(tmp_path, filepath)
+    finally:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    loop = asyncio.get_running_loop()
+    h, text = await loop.run_in_executor(_THREAD_POOL, _process_file, file.filename, md5.hexdigest())
+
+    if not text.strip():
+        return f"Could not extract text from {file.filename}."
+
+    doc = {"hash": h, "text": text}
+    if faiss is not None:
+        is_pdf = file.filename.lower().endswith(".pdf")
+        doc["chunks"], doc["embeddings"] = await loop.run_in_executor(_THREAD_POOL, _embed_document, text, h, is_pdf)
+
+    # Stored from a worker thread, since the lock may be held by a rebuild in progress
+    await loop.run_in_executor(_THREAD_POOL, _store_document, file.filename.lower(), doc)
+    return None
+
+
+@app.post("/upload")
+async def upload_pdf(files: list[UploadFile] = File(...)):
+    try:
+        # Same-named files would stream into the same .part file, so only the first is kept
+        unique = {}
+        errors = []
+        for f in files:
+            if f.filename.lower() in unique:
+                errors.append(f"{f.filename} was included more than once.")
+            else:
+                unique[f.filename.lower()] = f
+
+        # One failing file must not abort the rest, or stored files would miss the rebuild below
+        results = await asyncio.gather(*[_handle_upload(f) for f in unique.values()], return_exceptions=True)
+        processed = 0
+        for f, result in zip(unique.values(), results):
+            if isinstance(result, Exception):
+                errors.append(f"{f.filename} failed: {str(result)}")
+            elif result:
+                errors.append(result)
+            else:
+                processed += 1
+
+        if processed > 0:
+            _forget_history()
+            # Stacking embeddings and building the index grows with the corpus; keep it off the loop
+            await asyncio.get_running_loop().run_in_executor(_THREAD_POOL, _rebuild_locked)
+
+        msg = f"{processed} file(s) processed successfully."
+        if errors:
+            msg += " Issues: " + " | ".join(errors)
+
+        return {"message": msg}
+
+    except Exception as e:
+        return {"message": f"Upload failed: {str(e)}"}
+
+
+# ---------------- ASK ----------------
+IMAGE_KEYWORDS = frozenset({"draw", "generate image", "create diagram", "create flowchart", "show diagram", "make flowchart"})
+_IMG_RE = re.compile("|".join(map(re.escape, sorted(IMAGE_KEYWORDS))))
+
+
+def _image_url(question):
+    return f"https://image.pollinations.ai/prompt/{urllib.parse.quote(question)}"
+
+
+def _stream_answer(stream, user_msg):
+    # Relays completion deltas as SSE events, then records whatever answer was produced
+    parts = []
+    try:
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield f"data: {json.dumps(delta)}\n\n"
+    except Exception as e:
+        yield f"data: {json.dumps(f'⚠️ Error: {str(e)}')}\n\n"
+    finally:
+        # Also runs when the client disconnects and the generator is closed
+        try:
+            if parts:
+                _remember("assistant", "".join(parts))
+            else:
+                _forget(user_msg)
+        except Exception as e:
+            print(f"History update failed: {e}")
+        # Release the Groq HTTP stream now rather than at garbage collection
+        try:
+            stream.close()
+        except Exception as e:
+            print(f"Closing completion stream failed: {e}")
+
+
+@app.post("/ask")
+def ask_ai(q: Question):
+    try:
+        user_text = q.question.lower()
 
-        CHAT_HISTORY.append({"role": "user", "content": q.question})
+        if _IMG_RE.search(user_text) is not None:
+            return {"image": _image_url(q.question)}
 
-        if len(CHAT_HISTORY) > 21:
-            CHAT_HISTORY = [CHAT_HISTORY[0]] + CHAT_HISTORY[-20:]
+        system_msg = _SYSTEM_MSG
+        # Only the chunks most relevant to this question go into the prompt
+        material = _retrieve(q.question) if faiss is not None else None
+        if material:
+            system_msg = {"role": "system", "content": SYSTEM_PROMPT_TEMPLATE.format(combined_text=material)}
 
-        completion = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=CHAT_HISTORY
-        )
+        user_msg = _remember("user", q.question)
 
-        answer = completion.choices[0].message.content
-        CHAT_HISTORY.append({"role": "assistant", "content": answer})
+        try:
+            stream = client.chat.completions.create(
+                model="llama-3.3-70b-versatile",
+                messages=[system_msg, *_history_snapshot()],
+                stream=True
+            )
+        except Exception:
+            _forget(user_msg)
+            raise
 
-        return {"answer": answer}
+        return StreamingResponse(_stream_answer(stream, user_msg), media_type="text/event-stream")
 
     except Exception as e:
         return {"answer": f"⚠️ Error: {str(e)}"}
@@ -279,4 +619,6 @@ def health():
 
 
 # ---------------- FRONTEND ----------------
-app.mount("/", StaticFiles(directory="../Frontend", html=True), name="frontend")
\ No newline at end of file
+# In production nginx serves ../Frontend directly (see nginx.conf); set SERVE_STATIC=0 there
+if os.getenv("SERVE_STATIC", "1") != "0":
+    app.mount("/", StaticFiles(directory="../Frontend", html=True), name="frontend")
\ No newline at end of file
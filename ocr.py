@@ -0,0 +1,71 @@
+import os
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pdf2image import convert_from_path
+import pytesseract
+from PIL import Image
+
+# Runs inside the OCR worker processes, so importing this module must stay
+# cheap and side-effect free (no app, clients or models at module level).
+
+TESSERACT_CMD = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+OCR_DPI = 300
+OCR_THRESHOLD = 180  # grayscale level above which a pixel becomes white
+OCR_CONFIG = "--oem 1 --psm 6 -c tessedit_do_invert=0"
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _init_worker():
+    # One single-threaded tesseract per worker process
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+
+
+def _ocr_batch(list_path, image_paths):
+    # Binarize pages up front so tesseract skips its own conversion
+    for path in image_paths:
+        with Image.open(path) as img:
+            bilevel = img.point(lambda p: 255 if p > OCR_THRESHOLD else 0, mode="1")
+        bilevel.save(path)
+
+    # Tesseract's list-file mode loads the language model once for the whole shard
+    with open(list_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(image_paths))
+    return pytesseract.image_to_string(list_path, config=OCR_CONFIG)
+
+
+def _get_pool():
+    # Spawned workers never fork the threaded server process and only import this module
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return _POOL
+
+
+def ocr_pdf(filepath):
+    with tempfile.TemporaryDirectory() as tmp:
+        image_paths = convert_from_path(
+            filepath,
+            dpi=OCR_DPI,
+            grayscale=True,
+            output_folder=tmp,
+            fmt="png",
+            paths_only=True,
+            thread_count=os.cpu_count(),
+        )
+        if not image_paths:
+            return ""
+        workers = min(os.cpu_count() or 1, len(image_paths))
+        size = -(-len(image_paths) // workers)
+        shards = [image_paths[i:i + size] for i in range(0, len(image_paths), size)]
+        list_paths = [os.path.join(tmp, f"list_{k}.txt") for k in range(len(shards))]
+        return "".join(_get_pool().map(_ocr_batch, list_paths, shards))